@@ -1,9 +1,16 @@
-import re
+import threading
+from collections import OrderedDict
+from collections.abc import Collection
+from functools import lru_cache, partial
 from inspect import Parameter, signature
-from typing import List, Type
+from typing import (
+    Any, Callable, Dict, List, Mapping, MutableMapping, NamedTuple, Optional,
+    Tuple, Type,
+)
+from weakref import WeakKeyDictionary, WeakValueDictionary
 
 from apistar import (
-    codecs, exceptions, validators, http, types,
+    App, codecs, exceptions, validators, http, types,
     Route as _Route,
 )
 from apistar.conneg import negotiate_content_type
@@ -16,32 +23,68 @@ try:
     import pydantic
 except ImportError:
     pydantic = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 __ALL__ = [
     'QueryParam', 'PathParam', 'BodyData', 'DictQueryData',
-    'Route', 'components'
+    'Route', 'components', 'build_components', 'serve_schema',
 ]
 
 if pydantic:
     __ALL__.extend([
-        'PydanticBodyData', 'PyDanticQueryData'
+        'PydanticBodyData', 'PyDanticQueryData',
+        'TrustedPydanticBodyData', 'TrustedPydanticQueryData',
     ])
 
 
 class ParamData:
 
-    def __getitem__(self, type_cls):
-        return type(type_cls.__name__, (type_cls, self.__class__), {})
+    # markers only carry type identity, don't give annotated values a __dict__
+    __slots__ = ()
+
+    # Kind of parameter, inherited by generated classes. Route's
+    # generate_fields() dispatches on it, and components check it along with
+    # the marker class.
+    __param_kind__ = 'param_data'
+
+    # One generated class per marker and annotated type, so QueryParam[int]
+    # is always the same class. Weak, so unused generated classes can be
+    # collected.
+    _cache: MutableMapping[Tuple[Type, Type], Type] = WeakValueDictionary()
+
+    def __class_getitem__(cls, type_cls):
+        assert isinstance(type_cls, type), f"{type_cls!r} is not a class"
+        key = (cls, type_cls)
+        cached = cls._cache.get(key)
+        if cached is not None:
+            return cached
+        new_cls = type(type_cls.__name__, (type_cls, cls), {
+            '__slots__': (),
+            '__module__': type_cls.__module__,
+        })
+        cls._cache[key] = new_cls
+        return new_cls
 
 
 class _QueryParam(ParamData):
     """Annotation for parameters received in the query string."""
 
+    __slots__ = ()
+
+    __param_kind__ = 'query_param'
+
 
 class _PathParam(ParamData):
     """Annotation for parameters received in the path."""
 
+    __slots__ = ()
+
+    __param_kind__ = 'path_param'
+
 
 class _BodyData(ParamData):
     """Annotation for parameters received in the body data.
@@ -50,6 +93,10 @@ class _BodyData(ParamData):
     documentation.
     """
 
+    __slots__ = ()
+
+    __param_kind__ = 'body_data'
+
 
 class _DictQueryData(ParamData):
     """Annotation for dict like parameters received in the query string.
@@ -58,22 +105,167 @@ class _DictQueryData(ParamData):
     documentation.
     """
 
+    __slots__ = ()
+
+    __param_kind__ = 'dict_query_data'
 
-QueryParam = _QueryParam()
-PathParam = _PathParam()
-BodyData = _BodyData()
-DictQueryData = _DictQueryData()
+
+QueryParam = _QueryParam
+PathParam = _PathParam
+BodyData = _BodyData
+DictQueryData = _DictQueryData
 
 
 if pydantic:
     class _PydanticBodyData(_BodyData):
         """Annotation for pydantic parameters received in the body data."""
 
+        __slots__ = ()
+
+        __param_kind__ = 'pydantic_body_data'
+
     class _PydanticQueryData(_DictQueryData):
         """Annotation for pydantic parameters received in the query string."""
 
-    PydanticBodyData = _PydanticBodyData()
-    PydanticQueryData = _PydanticQueryData()
+        __slots__ = ()
+
+        __param_kind__ = 'pydantic_query_data'
+
+    class _TrustedPydanticBodyData(_PydanticBodyData):
+        """Annotation for trusted pydantic parameters received in the body.
+
+        Values are assigned without validation, only use it for data coming
+        from trusted sources.
+        """
+
+        __slots__ = ()
+
+    class _TrustedPydanticQueryData(_PydanticQueryData):
+        """Annotation for trusted pydantic parameters received in the query.
+
+        Values are assigned without validation, only use it for data coming
+        from trusted sources.
+        """
+
+        __slots__ = ()
+
+    # Trust is told by the marker class, not by an attribute a model could
+    # shadow, since markers come after the model in generated classes.
+    _TRUSTED_MARKERS = (_TrustedPydanticBodyData, _TrustedPydanticQueryData)
+
+    PydanticBodyData = _PydanticBodyData
+    PydanticQueryData = _PydanticQueryData
+    TrustedPydanticBodyData = _TrustedPydanticBodyData
+    TrustedPydanticQueryData = _TrustedPydanticQueryData
+
+
+# Field location of documentable parameter kinds. Parameters of any other
+# kind aren't documentable.
+_FIELD_LOCATIONS = {
+    'path_param': 'path',
+    'query_param': 'query',
+    'body_data': 'body',
+}
+
+if pydantic:
+    _FIELD_LOCATIONS['pydantic_body_data'] = 'body'
+
+
+class _ParamDesc(NamedTuple):
+    """What Route.generate_fields() needs to know about a handler parameter."""
+
+    name: str
+    kind: Optional[str]
+    annotation: Any
+    default: Any
+
+
+# Parameter descriptions by handler, weakly referenced like _FIELDS_CACHE.
+_DESCRIPTORS_CACHE: MutableMapping[
+    Callable, Tuple[_ParamDesc, ...]
+] = WeakKeyDictionary()
+
+
+def _handler_descriptors(handler):
+    try:
+        return _DESCRIPTORS_CACHE[handler]
+    except KeyError:
+        pass
+    except TypeError:
+        # not weakly referenceable, e.g. an instance with __slots__
+        return _describe_handler(handler)
+    descriptors = _DESCRIPTORS_CACHE[handler] = _describe_handler(handler)
+    return descriptors
+
+
+def _describe_handler(handler):
+    return tuple(
+        _ParamDesc(
+            name=name,
+            kind=getattr(param.annotation, '__param_kind__', None),
+            annotation=param.annotation,
+            default=param.default,
+        )
+        for name, param in signature(handler).parameters.items()
+    )
+
+
+@lru_cache(maxsize=None)
+def _path_names(url):
+    """Return the variable names of an URL template like '/{id}/{+path}'."""
+    names = []
+    start = url.find('{')
+    while start != -1:
+        end = url.find('}', start)
+        if end == -1:
+            break
+        names.append(url[start + 1:end].lstrip('+'))
+        start = url.find('{', end)
+    return frozenset(names)
+
+
+# Validators of scalar types a path or query parameter may be.
+_SCALAR_VALIDATORS = {
+    int: validators.Integer,
+    float: validators.Number,
+    str: validators.String,
+}
+
+
+def _scalar_validator(annotation):
+    for base in annotation.__mro__:
+        validator_cls = _SCALAR_VALIDATORS.get(base)
+        if validator_cls is not None:
+            return validator_cls
+    return None
+
+
+# Validator classes of plain annotations apistar documents as path and query
+# parameters. Unannotated parameters are documented without a schema.
+_FALLBACK_PATH_CLS = {
+    Parameter.empty: None,
+    int: validators.Integer,
+    float: validators.Number,
+    str: validators.String,
+}
+
+_FALLBACK_QUERY_CLS = {
+    Parameter.empty: None,
+    int: validators.Integer,
+    float: validators.Number,
+    bool: validators.Boolean,
+    str: validators.String,
+    http.QueryParam: validators.String,
+}
+
+
+# Generated fields by handler, then route class, url and method; they only
+# depend on those, and apps rebuilt over the same handlers (tests, reloads)
+# reuse them. Handlers are weakly referenced so that dropping a route frees
+# its fields.
+_FIELDS_CACHE: MutableMapping[
+    Callable, Dict[Tuple[Type, str, str], Tuple[Field, ...]]
+] = WeakKeyDictionary()
 
 
 class Route(_Route):
@@ -82,27 +274,39 @@ class Route(_Route):
         if not self.documented:
             return []
 
+        try:
+            handler_fields = _FIELDS_CACHE.setdefault(handler, {})
+        except TypeError:
+            # not weakly referenceable, e.g. an instance with __slots__
+            handler_fields = {}
+
+        key = (self.__class__, url, method)
+        fields = handler_fields.get(key)
+        if fields is None:
+            fields = handler_fields[key] = tuple(
+                self._generate_fields(url, method, handler))
+        return list(fields)
+
+    def _generate_fields(self, url, method, handler):
         fields = []
+        path_names = _path_names(url)
 
-        for name, param in signature(handler).parameters.items():
-            if issubclass(param.annotation, _PathParam):
-                if issubclass(param.annotation, int):
-                    validator_cls = validators.Integer
-                elif issubclass(param.annotation, float):
-                    validator_cls = validators.Number
-                elif issubclass(param.annotation, str):
-                    validator_cls = validators.String
-                else:
+        for param in _handler_descriptors(handler):
+            name, kind = param.name, param.kind
+            location = _FIELD_LOCATIONS.get(kind)
+
+            if location == 'path':
+                validator_cls = _scalar_validator(param.annotation)
+                if validator_cls is None:
                     raise exceptions.ConfigurationError(
                         f"Cannot handle {name} of {handler}")
 
-                location = 'path'
                 schema = validator_cls()
                 field = Field(name=name, location=location, schema=schema)
                 fields.append(field)
 
-            elif issubclass(param.annotation, _QueryParam):
-                if param.default is param.empty:
+            elif location == 'query':
+                if param.default is Parameter.empty:
                     kwargs = {}
                 elif param.default is None:
                     # TODO handle Optional
@@ -110,65 +314,46 @@ class Route(_Route):
                 else:
                     kwargs = {'default': param.default}
 
-                if issubclass(param.annotation, int):
-                    validator_cls = validators.Integer
-                elif issubclass(param.annotation, float):
-                    validator_cls = validators.Number
-                elif issubclass(param.annotation, str):
+                validator_cls = _scalar_validator(param.annotation)
+                if validator_cls is None:
+                    if issubclass(param.annotation, Collection):
+                        # a single query value can't build a dict or a list
+                        raise exceptions.ConfigurationError(
+                            f"Cannot handle {name} of {handler}")
+                    # other types (Decimal, UUID, date...) are parsed from
+                    # the query string, so document them as strings
                     validator_cls = validators.String
-                elif getattr(param.annotation, '__bool__', None):
-                    validator_cls = validators.Boolean
-                else:
-                    raise exceptions.ConfigurationError(
-                        f"Cannot handle {name} of {handler}")
 
-                location = 'query'
                 schema = validator_cls(**kwargs)
                 field = Field(name=name, location=location, schema=schema)
                 fields.append(field)
 
-            elif issubclass(param.annotation, _BodyData):
-                location = 'body'
+            elif location == 'body':
                 schema = validators.Object()
                 field = Field(name=name, location=location, schema=schema)
                 fields.append(field)
 
-            elif issubclass(param.annotation, ParamData):
+            elif kind is not None:
                 raise exceptions.ConfigurationError(
                     f"{param.annotation} do not support documentation.")
 
             else:
                 # fallback to original generate_fields() method
-                path_names = [
-                    item.strip('{}').lstrip('+')
-                    for item in re.findall('{[^}]*}', url)
-                ]
                 if name in path_names:
-                    schema = {
-                        param.empty: None,
-                        int: validators.Integer(),
-                        float: validators.Number(),
-                        str: validators.String()
-                    }[param.annotation]
+                    validator_cls = _FALLBACK_PATH_CLS[param.annotation]
+                    schema = validator_cls() if validator_cls else None
                     field = Field(name=name, location='path', schema=schema)
                     fields.append(field)
 
-                elif param.annotation in (param.empty, int, float, bool, str,
-                                          http.QueryParam):
-                    if param.default is param.empty:
+                elif param.annotation in _FALLBACK_QUERY_CLS:
+                    if param.default is Parameter.empty:
                         kwargs = {}
                     elif param.default is None:
                         kwargs = {'default': None, 'allow_null': True}
                     else:
                         kwargs = {'default': param.default}
-                    schema = {
-                        param.empty: None,
-                        int: validators.Integer(**kwargs),
-                        float: validators.Number(**kwargs),
-                        bool: validators.Boolean(**kwargs),
-                        str: validators.String(**kwargs),
-                        http.QueryParam: validators.String(**kwargs),
-                    }[param.annotation]
+                    validator_cls = _FALLBACK_QUERY_CLS[param.annotation]
+                    schema = validator_cls(**kwargs) if validator_cls else None
                     field = Field(name=name, location='query', schema=schema)
                     fields.append(field)
 
@@ -187,10 +372,12 @@ class Route(_Route):
         return fields
 
 
+_MISSING = object()
+
+
 def resolve(parameter: Parameter, params_dict):
-    try:
-        value = params_dict[parameter.name]
-    except KeyError:
+    value = params_dict.get(parameter.name, _MISSING)
+    if value is _MISSING:
         if parameter.default is not parameter.empty:
             return parameter.default
         else:
@@ -207,7 +394,16 @@ class ParameterHandlerMixin:
     annotation: Type
 
     def can_handle_parameter(self, parameter: Parameter):
-        return issubclass(parameter.annotation, self.annotation)
+        # Markers derived from another one with their own kind (e.g. pydantic
+        # body data) belong to their own component, whatever the order of
+        # components. Annotations other than markers have no kind at all.
+        annotation = parameter.annotation
+        kind = getattr(annotation, '__param_kind__', None)
+        return (
+            kind == getattr(self.annotation, '__param_kind__', None) and
+            isinstance(annotation, type) and
+            issubclass(annotation, self.annotation)
+        )
 
 
 class PathParamsComponent(ParameterHandlerMixin, Component):
@@ -236,16 +432,68 @@ class DataComponent(Component):
         return parameter.annotation(value_dict)
 
 
+if orjson:
+    __ALL__.append('FastJSONCodec')
+
+    class FastJSONCodec(codecs.JSONCodec):
+        """JSON codec decoding with orjson.
+
+        Unlike the default codec, integers beyond 64 bits are decoded as
+        floats, NaN and Infinity are rejected and objects become plain
+        dicts. Opt in by overriding ``BodyDataComponent.codecs``.
+        """
+
+        def decode(self, bytestring, **options):
+            try:
+                return orjson.loads(bytestring)
+            except orjson.JSONDecodeError as exc:
+                raise exceptions.ParseError(
+                    'Malformed JSON. %s' % exc) from None
+
+
 class BodyDataComponent(ParameterHandlerMixin, DataComponent):
 
     annotation = _BodyData
 
+    # codecs are stateless, so all components share the same instances
+    codecs = (
+        codecs.JSONCodec(),
+        codecs.URLEncodedCodec(),
+        codecs.MultiPartCodec(),
+    )
+
+    # Most requests repeat a handful of Content-Type values, so the codec
+    # negotiated for each of them is remembered, up to this many entries.
+    codec_cache_size = 32
+
     def __init__(self):
-        self.codecs = [
-            codecs.JSONCodec(),
-            codecs.URLEncodedCodec(),
-            codecs.MultiPartCodec(),
-        ]
+        super().__init__()
+        self._codec_cache: OrderedDict = OrderedDict()
+        self._codec_lock = threading.Lock()
+
+    def get_codec(self, content_type):
+        # sync apps resolve requests from several threads at once, and the
+        # OrderedDict reordering below isn't atomic
+        with self._codec_lock:
+            cache = self._codec_cache
+            codec = cache.get(content_type)
+            if codec is not None:
+                cache.move_to_end(content_type)
+                return codec
+
+            codec = negotiate_content_type(self.codecs, content_type)
+            if len(cache) >= self.codec_cache_size:
+                # evict the least recently used entry, so varying headers
+                # (e.g. multipart boundaries) can't push out the common ones
+                cache.popitem(last=False)
+            cache[content_type] = codec
+            return codec
+
+    def negotiate_codec(self, headers: Headers):
+        try:
+            return self.get_codec(headers.get('Content-Type'))
+        except exceptions.NoCodecAvailable:
+            raise exceptions.UnsupportedMediaType()
 
     def resolve(self,
                 content: Body,
@@ -253,12 +501,11 @@ class BodyDataComponent(ParameterHandlerMixin, DataComponent):
                 parameter: Parameter):
         if not content:
             raise NotImplementedError
+        codec = self.negotiate_codec(headers)
+        return self.decode_parameter(codec, content, headers, parameter)
 
-        content_type = headers.get('Content-Type')
-        try:
-            codec = negotiate_content_type(self.codecs, content_type)
-        except exceptions.NoCodecAvailable:
-            raise exceptions.UnsupportedMediaType()
+    def decode_parameter(self, codec, content, headers, parameter):
+        """Decode the body with the negotiated codec and handle the value."""
         try:
             value = codec.decode(content, headers=headers)
         except exceptions.ParseError as exc:
@@ -284,33 +531,151 @@ class DictQueryDataComponent(ParameterHandlerMixin, DataComponent):
 
 if pydantic:
 
-    class PydanticBodyDataComponent(BodyDataComponent):
+    _VALIDATE_JSON = hasattr(pydantic.BaseModel, 'model_validate_json')
 
-        annotation: Type = _PydanticBodyData
+    @lru_cache(maxsize=None)
+    def _nested_models(model):
+        """Return (name, model) pairs of fields holding a pydantic model."""
+        fields = getattr(model, 'model_fields', None)  # pydantic >= 2
+        if fields is not None:
+            field_types = {name: f.annotation for name, f in fields.items()}
+        else:
+            field_types = {name: f.outer_type_
+                           for name, f in model.__fields__.items()}
+        return tuple(
+            (name, field_type) for name, field_type in field_types.items()
+            if isinstance(field_type, type) and
+            issubclass(field_type, pydantic.BaseModel)
+        )
+
+    def _construct_model(model, values):
+        """Create a pydantic model from trusted values without validating.
+
+        Nested models received as dicts are constructed as well.
+        """
+        nested = _nested_models(model)
+        if nested:
+            values = dict(values)
+            for name, field_type in nested:
+                value = values.get(name)
+                if isinstance(value, Mapping):
+                    values[name] = _construct_model(field_type, value)
+        construct = getattr(model, 'model_construct', None)  # pydantic >= 2
+        if construct is None:
+            construct = model.construct
+        return construct(**values)
+
+    def _validate_model(model, values):
+        return model(**values)
+
+    def _validate_python(model, values):
+        # pydantic >= 2, skip the BaseModel.__init__ indirection. Only for
+        # dicts: pydantic-core ignores custom __init__ methods given other
+        # mappings, and query params may repeat keys, which model(**values)
+        # rejects on both pydantic versions.
+        if isinstance(values, dict):
+            return model.__pydantic_validator__.validate_python(values)
+        return model(**values)
+
+    class PydanticDataMixin:
+
+        # Trusted input (e.g. from internal services) skips validation and
+        # is assigned as is. Never enable it for data sent by clients.
+        trust_input: bool = False
+
+        def __init__(self):
+            super().__init__()
+            self._coercers: Dict[Type, Callable] = {}
+
+        def get_coercer(self, annotation):
+            """Return the function building an annotation from a dict."""
+            if self.trust_input or issubclass(annotation, _TRUSTED_MARKERS):
+                return partial(_construct_model, annotation)
+            if hasattr(annotation, '__pydantic_validator__'):
+                return partial(_validate_python, annotation)
+            return partial(_validate_model, annotation)
 
         def handle_parameter(self, parameter, value_dict):
-            return parameter.annotation(**value_dict)
+            annotation = parameter.annotation
+            coercer = self._coercers.get(annotation)
+            if coercer is None:
+                coercer = self._coercers[annotation] = self.get_coercer(
+                    annotation)
+            return coercer(value_dict)
+
+    class PydanticBodyDataComponent(PydanticDataMixin, BodyDataComponent):
 
-    class PydanticQueryDataComponent(DictQueryDataComponent):
+        annotation: Type = _PydanticBodyData
+
+        def __init__(self):
+            super().__init__()
+            # pydantic 2 parses and validates JSON bodies in a single pass,
+            # unless a subclass customizes how values become models
+            cls = type(self)
+            self._validate_json = (
+                _VALIDATE_JSON and
+                cls.handle_parameter is PydanticDataMixin.handle_parameter and
+                cls.get_coercer is PydanticDataMixin.get_coercer
+            )
+
+        def resolve(self,
+                    content: Body,
+                    headers: Headers,
+                    parameter: Parameter):
+            if not content:
+                raise NotImplementedError
+            codec = self.negotiate_codec(headers)
+
+            annotation = parameter.annotation
+            if (self._validate_json and type(codec) is codecs.JSONCodec and
+                    not self.trust_input and
+                    not issubclass(annotation, _TRUSTED_MARKERS)):
+                try:
+                    return annotation.__pydantic_validator__.validate_json(
+                        content)
+                except Exception:
+                    raise exceptions.BadRequest(f"{parameter.name} invalid")
+            return self.decode_parameter(codec, content, headers, parameter)
+
+    class PydanticQueryDataComponent(PydanticDataMixin,
+                                     DictQueryDataComponent):
 
         annotation: Type = _PydanticQueryData
 
-        def handle_parameter(self, parameter, value_dict):
-            return parameter.annotation(**value_dict)
 
+# Encoded OpenAPI schema by app, along with the document it was encoded from.
+_SCHEMA_CACHE: MutableMapping[App, Tuple[Any, bytes]] = WeakKeyDictionary()
 
-components: List[Component] = []
 
-if pydantic:
-    # try pydantic components before others
-    components.extend([
-        PydanticBodyDataComponent(),
-        PydanticQueryDataComponent(),
+def serve_schema(app: App):
+    """Serve the OpenAPI schema of an app, encoded once per document."""
+    cached = _SCHEMA_CACHE.get(app)
+    if cached is None or cached[0] is not app.document:
+        content = codecs.OpenAPICodec().encode(app.document)
+        cached = _SCHEMA_CACHE[app] = (app.document, content)
+    headers = {'Content-Type': 'application/vnd.oai.openapi'}
+    return http.Response(cached[1], headers=headers)
+
+
+def build_components(enable_pydantic: bool = True) -> List[Component]:
+    """Create the components resolving the annotations of this module.
+
+    apistar concatenates the components given to an app with its own list,
+    so they are returned as a list too.
+    """
+    built: List[Component] = []
+    if pydantic and enable_pydantic:
+        built.extend([
+            PydanticBodyDataComponent(),
+            PydanticQueryDataComponent(),
+        ])
+    built.extend([
+        PathParamsComponent(),
+        QueryParamComponent(),
+        BodyDataComponent(),
+        DictQueryDataComponent(),
     ])
+    return built
+
 
-components.extend([
-    PathParamsComponent(),
-    QueryParamComponent(),
-    BodyDataComponent(),
-    DictQueryDataComponent(),
-])
+components: List[Component] = build_components()
@@ -14,11 +14,15 @@ setup(
     author_email='pslacerda@gmail.com',
     url='https://github.com/pslacerda/apistar_pydantic',
     py_modules=['apistar_pydantic'],
+    python_requires='>=3.7',
     include_package_data=True,
     zip_safe=False,
     install_requires=[
         'apistar',
     ],
+    extras_require={
+        'orjson': ['orjson'],  # faster JSON body decoding
+    },
     license="MIT license",
     keywords='apistar pydantic',
     classifiers=[
@@ -27,7 +31,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
     test_suite='tests',
     tests_require=[
@@ -1,15 +1,27 @@
+import gc
+import json
+import threading
+import weakref
+from decimal import Decimal
+from inspect import Parameter
+from types import MappingProxyType
+from urllib.parse import urlencode
+
 import pytest
 
-from apistar import App, ASyncApp
+from apistar import App, ASyncApp, codecs, exceptions, http, validators
+from apistar.document import Document
+from apistar.server.components import Component
 from apistar.test import TestClient
 from apistar.http import JSONResponse
-from apistar.server.handlers import serve_schema
 from pydantic import BaseModel
 
 from apistar_pydantic import (
     PathParam, QueryParam, BodyData, DictQueryData,
-    PydanticBodyData, PydanticQueryData,
-    Route, components,
+    PydanticBodyData, PydanticQueryData, TrustedPydanticBodyData,
+    BodyDataComponent, PydanticBodyDataComponent,
+    ParamData, ParameterHandlerMixin,
+    Route, build_components, components, serve_schema, _SCHEMA_CACHE,
 )
 
 
@@ -23,16 +35,16 @@ def _compute(self):
 class Model(dict):
 
     def __init__(self, value):
-        try:
-            new_value = {}
-            new_value['integer'] = int(value['integer'])
-            new_value['text'] = str(value['text'])
-            super().__init__(new_value)
-        except Exception:
-            raise Exception("Invalid model")
-
-    def __getattr__(self, key):
-        return self[key]
+        # invalid values raise KeyError or ValueError, both reported by the
+        # components as a bad request
+        integer = value['integer']
+        if type(integer) is not int:
+            integer = int(integer)
+        text = value['text']
+        if type(text) is not str:
+            text = str(text)
+        super().__init__(integer=integer, text=text)
+        self.__dict__.update(self)
 
     compute = _compute
 
@@ -44,6 +56,57 @@ class PydanticModel(BaseModel):
     compute = _compute
 
 
+def test_param_data_identity():
+    assert QueryParam[int] is QueryParam[int]
+    assert QueryParam[int] is not PathParam[int]
+
+
+def test_codec_cache():
+    component = BodyDataComponent()
+    component.codec_cache_size = 2
+
+    json_codec = component.get_codec('application/json')
+    component.get_codec('application/x-www-form-urlencoded')
+    assert component.get_codec('application/json') is json_codec
+    component.get_codec('multipart/form-data; boundary=xyz')
+    assert list(component._codec_cache) == [
+        'application/json', 'multipart/form-data; boundary=xyz']
+
+
+def test_codec_cache_threads():
+    component = BodyDataComponent()
+    component.codec_cache_size = 2
+    content_types = ['multipart/form-data; boundary=%d' % i for i in range(8)]
+    errors = []
+
+    def work():
+        try:
+            for _ in range(500):
+                for content_type in content_types:
+                    component.get_codec(content_type)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(component._codec_cache) <= 2
+
+
+def test_build_components():
+    assert len(build_components()) == len(components)
+    assert not any(isinstance(component, PydanticBodyDataComponent)
+                   for component in build_components(enable_pydantic=False))
+
+
+@pytest.fixture(scope='module', params=[ASyncApp, App])
+def app_class(request):
+    return request.param
+
+
 def client_factory(app_class, routes):
     app = app_class(
         components=components,
@@ -52,7 +115,6 @@ def client_factory(app_class, routes):
     return TestClient(app)
 
 
-@pytest.mark.parametrize('app_class', [ASyncApp, App])
 def test_url(app_class):
     def handler(arg1: PathParam[str]):
         return JSONResponse(arg1.upper())
@@ -64,7 +126,6 @@ def test_url(app_class):
     assert res.json() == 'AAA'
 
 
-@pytest.mark.parametrize('app_class', [ASyncApp, App])
 def test_query_simple(app_class):
     def handler(arg1: QueryParam[int]):
         return arg1 * 10
@@ -72,23 +133,37 @@ def test_query_simple(app_class):
     client = client_factory(app_class, [
         Route('/resource', 'GET', handler),
     ])
-    res = client.get('/resource', params={'arg1': 10})
+    res = client.get('/resource?arg1=10')
     assert res.json() == 100
 
 
-args = {
+def test_query_default(app_class):
+    def handler(arg1: QueryParam[int] = 5):
+        return arg1 * 10
+
+    client = client_factory(app_class, [
+        Route('/resource', 'GET', handler),
+    ])
+    res = client.get('/resource')
+    assert res.json() == 50
+
+
+args = MappingProxyType({
     'integer': 10,
     'text': 'abc'
-}
+})
+
+args_query = urlencode(args)
+args_json = json.dumps(dict(args)).encode()
+json_headers = MappingProxyType({'Content-Type': 'application/json'})
 
 
-expected = {
+expected = MappingProxyType({
     'integer': 100,
     'text': 'ABC'
-}
+})
 
 
-@pytest.mark.parametrize('app_class', [ASyncApp, App])
 def test_query_model(app_class):
 
     def handler(model: DictQueryData[Model]):
@@ -98,11 +173,10 @@ def test_query_model(app_class):
         Route('/resource', 'GET', handler, documented=False)
     ])
 
-    res = client.get('/resource', params=args)
-    assert res.json() == expected
+    res = client.get('/resource?' + args_query)
+    assert res.json() == dict(expected)
 
 
-@pytest.mark.parametrize('app_class', [ASyncApp, App])
 def test_body_model(app_class):
 
     def handler(model: BodyData[Model]):
@@ -111,11 +185,80 @@ def test_body_model(app_class):
     client = client_factory(app_class, [
         Route('/resource', 'PUT', handler)
     ])
-    res = client.put('/resource', json=args)
-    assert res.json() == expected
+    res = client.put('/resource', data=args_json, headers=json_headers)
+    assert res.json() == dict(expected)
+
+
+def test_body_model_invalid(app_class):
+
+    def handler(model: BodyData[Model]):
+        return model.compute()
+
+    client = client_factory(app_class, [
+        Route('/resource', 'PUT', handler)
+    ])
+    res = client.put('/resource', json={'integer': 'a', 'text': 'abc'})
+    assert res.status_code == 400
+    res = client.put('/resource', json={'integer': 10})
+    assert res.status_code == 400
+
+
+def json_body_client(app_class, component):
+    def handler(body: BodyData[dict]):
+        return JSONResponse(body['number'])
+
+    app = app_class(
+        components=[component] + components,
+        routes=[Route('/resource', 'PUT', handler, documented=False)]
+    )
+    return TestClient(app)
+
+
+def test_json_body(app_class):
+    client = json_body_client(app_class, BodyDataComponent())
+    res = client.put('/resource', data=b'{"number": ', headers=json_headers)
+    assert res.status_code == 400
+    res = client.put('/resource', json={'number': 2 ** 70})
+    assert res.json() == 2 ** 70
+
+
+def test_fast_json_body(app_class):
+    pytest.importorskip('orjson')
+    from apistar_pydantic import FastJSONCodec
+
+    class FastBodyDataComponent(BodyDataComponent):
+        codecs = (FastJSONCodec(),)
+
+    client = json_body_client(app_class, FastBodyDataComponent())
+    res = client.put('/resource', data=b'{"number": ', headers=json_headers)
+    assert res.status_code == 400
+    res = client.put('/resource', data=b'{"number": NaN}',
+                     headers=json_headers)
+    assert res.status_code == 400
+    res = client.put('/resource', json={'number': 2 ** 70})
+    assert res.json() == float(2 ** 70)
+
+    class NumberModel(BaseModel):
+        number: float
+
+    class FastPydanticBodyDataComponent(PydanticBodyDataComponent):
+        codecs = (FastJSONCodec(),)
+
+    def handler(body: PydanticBodyData[NumberModel]):
+        return JSONResponse(body.number)
+
+    app = app_class(
+        components=[FastPydanticBodyDataComponent()] + components,
+        routes=[Route('/resource', 'PUT', handler, documented=False)]
+    )
+    client = TestClient(app)
+    res = client.put('/resource', data=b'{"number": NaN}',
+                     headers=json_headers)
+    assert res.status_code == 400
+    res = client.put('/resource', json={'number': 1.5})
+    assert res.json() == 1.5
 
 
-@pytest.mark.parametrize('app_class', [ASyncApp, App])
 def test_mixed_arguments(app_class):
 
     def handler(query: DictQueryData[Model],
@@ -127,11 +270,7 @@ def test_mixed_arguments(app_class):
     ])
 
     res = client.post(
-        '/resource',
-        params={
-            'integer': 2,
-            'text': 'a'
-        },
+        '/resource?integer=2&text=a',
         json={
             'integer': 2,
             'text': ''
@@ -139,7 +278,6 @@ def test_mixed_arguments(app_class):
     assert res.json() == 'aaaa'
 
 
-@pytest.mark.parametrize('app_class', [ASyncApp, App])
 def test_pydantic_model(app_class):
 
     def handler(query: PydanticQueryData[PydanticModel],
@@ -151,11 +289,7 @@ def test_pydantic_model(app_class):
     ])
 
     res = client.post(
-        '/resource',
-        params={
-            'integer': 2,
-            'text': 'a'
-        },
+        '/resource?integer=2&text=a',
         json={
             'integer': 2,
             'text': ''
@@ -163,8 +297,70 @@ def test_pydantic_model(app_class):
     assert res.json() == 'aaaa'
 
 
-@pytest.mark.parametrize('app_class', [ASyncApp, App])
-def test_schema(app_class):
+expected_schema = {
+    'openapi': '3.0.0',
+    'info': {
+        'title': '',
+        'description': '',
+        'version': ''
+    },
+    'paths': {
+        '/add_model': {
+            'post': {
+                'description': 'add_model description',
+                'operationId': 'add_model',
+                'requestBody': {
+                    'content': {
+                        'application/json': {
+                            'schema': {'type': 'object'}
+                        }
+                    }
+                }
+            }
+        },
+        '/list_models': {
+            'get': {
+                'description': 'list_models description',
+                'operationId': 'list_models'
+            }
+        },
+        '/show_model': {
+            'get': {
+                'description': 'show_model description',
+                'operationId': 'show_model',
+                'parameters': [
+                    {
+                        'name': 'id',
+                        'in': 'query',
+                        'schema': {'type': 'integer'}
+                    }
+                ]
+            }
+        },
+        '/show/model/{id}': {
+            'get': {
+                'description': 'show_model2 description',
+                'operationId': 'show_model2',
+                'parameters': [
+                    {
+                        'name': 'id',
+                        'in': 'path',
+                        'required': True,
+                        'schema': {'type': 'integer'}
+                    },
+                    {
+                        'name': 'name',
+                        'in': 'query',
+                        'schema': {'type': 'string'}
+                    }
+                ]
+            }
+        }
+    }
+}
+
+
+def test_schema(app_class, monkeypatch):
 
     def add_model(model: BodyData[Model]):
         """add_model description"""
@@ -190,71 +386,320 @@ def test_schema(app_class):
             Route('/show/model/{id}', 'GET', show_model2),
             Route('/schema/', 'GET', handler=serve_schema, documented=False),
         ],
+        schema_url=None,
         # settings={
         #     'SCHEMA': {'TITLE': 'My API'}
         # }
     )
+    encode = codecs.OpenAPICodec.encode
+    encoded = []
+
+    def counting_encode(self, document, **options):
+        encoded.append(document)
+        return encode(self, document, **options)
+
+    monkeypatch.setattr(codecs.OpenAPICodec, 'encode', counting_encode)
+
     client = TestClient(app)
     res = client.get('/schema')
     assert res.status_code == 200
-    assert res.json() == {
-        'openapi': '3.0.0',
-        'info': {
-            'title': '',
-            'description': '',
-            'version': ''
-        },
-        'paths': {
-            '/add_model': {
-                'post': {
-                    'description': 'add_model description',
-                    'operationId': 'add_model',
-                    'requestBody': {
-                        'content': {
-                            'application/json': {
-                                'schema': {'type': 'object'}
-                            }
-                        }
-                    }
-                }
-            },
-            '/list_models': {
-                'get': {
-                    'description': 'list_models description',
-                    'operationId': 'list_models'
-                }
-            },
-            '/show_model': {
-                'get': {
-                    'description': 'show_model description',
-                    'operationId': 'show_model',
-                    'parameters': [
-                        {
-                            'name': 'id',
-                            'in': 'query',
-                            'schema': {'type': 'integer'}
-                        }
-                    ]
-                }
-            },
-            '/show/model/{id}': {
-                'get': {
-                    'description': 'show_model2 description',
-                    'operationId': 'show_model2',
-                    'parameters': [
-                        {
-                            'name': 'id',
-                            'in': 'path',
-                            'required': True,
-                            'schema': {'type': 'integer'}
-                        },
-                        {
-                            'name': 'name',
-                            'in': 'query',
-                            'schema': {'type': 'string'}
-                        }
-                    ]
-                }
-            }
-        }
-    }
\ No newline at end of file
+    assert res.json() == expected_schema
+    assert _SCHEMA_CACHE[app] == (app.document, res.content)
+
+    assert client.get('/schema').content == res.content
+    assert encoded == [app.document]
+
+    app.document = Document(content=app.document.content, title='Other API')
+    res = client.get('/schema')
+    assert res.json()['info']['title'] == 'Other API'
+    assert encoded == [encoded[0], app.document]
+
+
+def test_route_fields_released():
+    def handler(id: PathParam[int], name: QueryParam[str]):
+        return
+
+    route = Route('/show/model/{id}', 'GET', handler)
+    assert [field.name for field in route.link.fields] == ['id', 'name']
+    handler_ref = weakref.ref(handler)
+    del handler, route
+    gc.collect()
+    assert handler_ref() is None
+
+    class SlottedHandler:
+        __slots__ = ()
+
+        def __call__(self, id: PathParam[int]):
+            return
+
+    route = Route('/show/model/{id}', 'GET', SlottedHandler(),
+                  name='show_model')
+    assert [field.name for field in route.link.fields] == ['id']
+
+
+def test_components_order(app_class):
+
+    def handler(body: PydanticBodyData[PydanticModel]):
+        return body.compute()
+
+    app = app_class(
+        components=list(reversed(components)),
+        routes=[Route('/resource', 'PUT', handler, documented=False)]
+    )
+    client = TestClient(app)
+    res = client.put('/resource', data=args_json, headers=json_headers)
+    assert res.json() == dict(expected)
+
+
+def test_custom_markers(app_class):
+
+    class First(ParamData):
+        __slots__ = ()
+
+    class Second(ParamData):
+        __slots__ = ()
+
+    class FirstComponent(ParameterHandlerMixin, Component):
+        annotation = First
+
+        def resolve(self, parameter: Parameter):
+            return parameter.annotation('first')
+
+    class SecondComponent(ParameterHandlerMixin, Component):
+        annotation = Second
+
+        def resolve(self, parameter: Parameter):
+            return parameter.annotation('second')
+
+    def handler(a: First[str], b: Second[str]):
+        return JSONResponse([a, b])
+
+    app = app_class(
+        components=[FirstComponent(), SecondComponent()] + components,
+        routes=[Route('/resource', 'GET', handler, documented=False)]
+    )
+    client = TestClient(app)
+    assert client.get('/resource').json() == ['first', 'second']
+
+
+def test_plain_annotation_component(app_class):
+
+    class Token(str):
+        pass
+
+    class TokenComponent(ParameterHandlerMixin, Component):
+        annotation = Token
+
+        def resolve(self) -> Token:
+            return Token('secret')
+
+    def handler(token: Token, arg1: QueryParam[str]):
+        return JSONResponse([token, arg1])
+
+    app = app_class(
+        components=[TokenComponent()] + components,
+        routes=[Route('/resource', 'GET', handler, documented=False)]
+    )
+    client = TestClient(app)
+    assert client.get('/resource?arg1=a').json() == ['secret', 'a']
+
+
+def test_derived_marker(app_class):
+
+    class RawBody(BodyData):
+        __slots__ = ()
+
+    class RawBodyComponent(ParameterHandlerMixin, Component):
+        annotation = RawBody
+
+        def resolve(self, parameter: Parameter, content: http.Body):
+            return parameter.annotation(content.decode())
+
+    def raw_handler(body: RawBody[str]):
+        return JSONResponse(body)
+
+    def handler(body: BodyData[dict]):
+        return JSONResponse(body)
+
+    app = app_class(
+        components=[RawBodyComponent()] + components,
+        routes=[
+            Route('/raw', 'PUT', raw_handler, documented=False),
+            Route('/resource', 'PUT', handler, documented=False),
+        ]
+    )
+    client = TestClient(app)
+    res = client.put('/raw', data=args_json, headers=json_headers)
+    assert res.json() == args_json.decode()
+    res = client.put('/resource', data=args_json, headers=json_headers)
+    assert res.json() == dict(args)
+
+
+def test_pydantic_trust_input(app_class):
+
+    class TrustedBodyDataComponent(PydanticBodyDataComponent):
+        trust_input = True
+
+    def handler(body: PydanticBodyData[PydanticModel]):
+        return JSONResponse(body.integer)
+
+    app = app_class(
+        components=[TrustedBodyDataComponent()],
+        routes=[Route('/resource', 'PUT', handler, documented=False)]
+    )
+    client = TestClient(app)
+    res = client.put('/resource', json={'integer': '2', 'text': 'a'})
+    assert res.json() == '2'
+
+
+def test_pydantic_handle_parameter_override(app_class):
+
+    class DefaultsBodyDataComponent(PydanticBodyDataComponent):
+        def handle_parameter(self, parameter, value_dict):
+            value_dict = dict({'text': 'default'}, **value_dict)
+            return super().handle_parameter(parameter, value_dict)
+
+    def handler(body: PydanticBodyData[PydanticModel]):
+        return JSONResponse(body.text)
+
+    app = app_class(
+        components=[DefaultsBodyDataComponent()],
+        routes=[Route('/resource', 'PUT', handler, documented=False)]
+    )
+    client = TestClient(app)
+    res = client.put('/resource', json={'integer': 2})
+    assert res.json() == 'default'
+
+
+def test_pydantic_body_invalid(app_class):
+
+    def handler(body: PydanticBodyData[PydanticModel]):
+        return body.compute()
+
+    client = client_factory(app_class, [
+        Route('/resource', 'PUT', handler, documented=False)
+    ])
+    res = client.put('/resource', json={'integer': 'a', 'text': 'abc'})
+    assert res.status_code == 400
+    res = client.put('/resource', data=b'{',
+                     headers={'Content-Type': 'application/json'})
+    assert res.status_code == 400
+    res = client.put('/resource', data=args_json, headers=json_headers)
+    assert res.json() == dict(expected)
+
+
+def test_pydantic_validate_attribute(app_class):
+
+    class ShadowingModel(PydanticModel):
+        _validate = None
+
+    def handler(body: PydanticBodyData[ShadowingModel]):
+        return JSONResponse(body.integer)
+
+    client = client_factory(app_class, [
+        Route('/resource', 'PUT', handler, documented=False)
+    ])
+    res = client.put('/resource', json={'integer': 'a', 'text': 'abc'})
+    assert res.status_code == 400
+
+
+def test_pydantic_query_custom_init(app_class):
+
+    class DefaultsModel(BaseModel):
+        integer: int
+
+        def __init__(self, **data):
+            data.setdefault('integer', 42)
+            super().__init__(**data)
+
+    def handler(query: PydanticQueryData[DefaultsModel]):
+        return JSONResponse(query.integer)
+
+    client = client_factory(app_class, [
+        Route('/resource', 'GET', handler, documented=False)
+    ])
+    assert client.get('/resource').json() == 42
+    assert client.get('/resource?integer=2').json() == 2
+    res = client.get('/resource?integer=2&integer=3')
+    assert res.status_code == 400
+
+
+class NestedPydanticModel(BaseModel):
+    model: PydanticModel
+
+
+def test_pydantic_trusted_data(app_class):
+
+    def handler(body: TrustedPydanticBodyData[NestedPydanticModel]):
+        return JSONResponse(body.model.integer)
+
+    client = client_factory(app_class, [
+        Route('/resource', 'PUT', handler, documented=False)
+    ])
+    res = client.put('/resource', json={
+        'model': {'integer': '2', 'text': 'a'}
+    })
+    assert res.json() == '2'
+
+
+def test_query_param_unsupported():
+
+    def handler(arg1: QueryParam[dict]):
+        return arg1
+
+    with pytest.raises(exceptions.ConfigurationError):
+        Route('/resource', 'GET', handler)
+
+    def list_handler(arg1: QueryParam[list]):
+        return arg1
+
+    with pytest.raises(exceptions.ConfigurationError):
+        Route('/resource', 'GET', list_handler)
+
+
+def test_query_param_other_types(app_class):
+
+    def handler(arg1: QueryParam[Decimal] = None):
+        return JSONResponse(str(arg1 * 2))
+
+    route = Route('/resource', 'GET', handler)
+    schema = route.link.fields[0].schema
+    assert isinstance(schema, validators.String)
+    assert schema.allow_null
+
+    client = client_factory(app_class, [route])
+    res = client.get('/resource?arg1=1.25')
+    assert res.json() == '2.50'
+
+
+def test_pydantic_form_body(app_class):
+
+    def handler(body: PydanticBodyData[PydanticModel]):
+        return body.compute()
+
+    client = client_factory(app_class, [
+        Route('/resource', 'PUT', handler, documented=False)
+    ])
+    res = client.put('/resource', data=args)
+    assert res.json() == dict(expected)
+
+
+def test_pydantic_body_negotiates_once(app_class):
+    negotiated = []
+
+    class CountingBodyDataComponent(PydanticBodyDataComponent):
+        def get_codec(self, content_type):
+            negotiated.append(content_type)
+            return super().get_codec(content_type)
+
+    def handler(body: PydanticBodyData[PydanticModel]):
+        return body.compute()
+
+    app = app_class(
+        components=[CountingBodyDataComponent()] + components,
+        routes=[Route('/resource', 'PUT', handler, documented=False)]
+    )
+    client = TestClient(app)
+    res = client.put('/resource', data=args)
+    assert res.json() == dict(expected)
+    assert negotiated == ['application/x-www-form-urlencoded']